@@ -1,4 +1,6 @@
-import os, json
+import os, re, json, queue, socket, threading
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
 from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import urlparse, unquote
 
@@ -7,16 +9,74 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 # Carpeta donde viven manifest.json y las partes
 PARTS_DIR = os.path.join(BASE_DIR, os.getenv("PARTS_DIR", "files"))
+MANIFEST_PATH = os.path.join(PARTS_DIR, "manifest.json")
 # (compat) si quieres forzar un nombre de descarga distinto al del manifest:
 DOWNLOAD_NAME_OVERRIDE = os.getenv("DOWNLOAD_FILE")  # opcional
 
+# Bloque de copia cuando no hay os.sendfile, y buffer de envío del socket
+CHUNK_SIZE = 1024 * 1024
+SNDBUF_SIZE = 1024 * 1024
+
+# Hilos fijos que atienden conexiones (cada conexión ocupa uno hasta cerrarse,
+# así que el mínimo es holgado aun con 1 CPU) y segundos de espera de una
+# keep-alive inactiva antes de cerrarla y liberar su hilo
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", str(max(32, (os.cpu_count() or 1) * 4))))
+KEEPALIVE_TIMEOUT = 5
+# Segundos que el envío de una descarga puede quedar detenido (cliente que
+# no lee) antes de cortarla; aparte del timeout de keep-alive
+TRANSFER_TIMEOUT = 300
+
+# Caché HTTP de /download: se puede guardar, pero 'no-cache' obliga a
+# revalidar cada vez (ETag/304), así un cambio en las partes se ve en seguida.
+# 'no-transform' evita que un proxy intente comprimir de nuevo el ZIP.
+DOWNLOAD_CACHE_CONTROL = "public, no-cache, no-transform"
+
+# Límites del árbol de archivos de /diag (niveles bajo BASE_DIR y líneas)
+DIAG_MAX_DEPTH = 2
+DIAG_MAX_LINES = 200
+
+# Caché de manifest.json: solo se vuelve a leer si cambia su mtime o tamaño.
+# Tupla (clave, manifest, partes resueltas); no mutar el manifest.
+_manifest_lock = threading.Lock()
+_manifest_cache = None
+
+# Rutas que no se sirven: con un segmento '..' o con nulos; en Windows
+# también con separador '\' o unidad (C:)
+_UNSAFE_PATH = re.compile(r"(?:^|/)\.\.(?:/|$)|\x00"
+                          + (r"|[\\:]" if os.name == "nt" else ""))
+
 class Handler(SimpleHTTPRequestHandler):
-    def translate_path(self, path):
-        path = urlparse(path).path
-        path = unquote(path)
-        if path in ("/", ""):
-            path = "/index.html"
-        return os.path.join(BASE_DIR, path.lstrip("/"))
+    # HTTP/1.1 para reutilizar la conexión entre peticiones (keep-alive);
+    # el timeout libera el hilo si el cliente deja la conexión inactiva
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    # Buffer de copia reutilizado por la conexión cuando no hay os.sendfile
+    _copy_buf = None
+
+    def setup(self):
+        super().setup()
+        # Sin Nagle (el último segmento no espera ACK) y buffer de envío amplio
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF_SIZE)
+
+    def end_headers(self):
+        # Si hay conexiones esperando un hilo libre, esta no se mantiene abierta
+        saturated = getattr(self.server, "saturated", None)
+        if not self.close_connection and saturated and saturated():
+            self.send_header("Connection", "close")
+        super().end_headers()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=BASE_DIR, **kwargs)
+
+    def send_head(self):
+        # translate_path (el de SimpleHTTPRequestHandler) descarta los '..'
+        # en vez de resolverlos: mejor 404 que servir otro archivo
+        path = self.path.split("?", 1)[0].split("#", 1)[0]
+        if _UNSAFE_PATH.search(unquote(path, errors="surrogatepass")):
+            self.send_error(404, "File not found")
+            return None
+        return super().send_head()
 
     def list_directory(self, path):
         self.send_error(403, "Directory listing disabled")
@@ -34,51 +94,184 @@ class Handler(SimpleHTTPRequestHandler):
 
     # -------- utilidades --------
     def _load_manifest(self):
-        man_path = os.path.join(PARTS_DIR, "manifest.json")
-        if not os.path.exists(man_path):
-            return None, f"manifest.json no encontrado en {PARTS_DIR}"
+        """
+        Devuelve (manifest, partes_resueltas, error). Las partes resueltas son
+        las de _resolve_parts y se guardan en caché junto con el manifest.
+        """
+        global _manifest_cache
         try:
-            with open(man_path, "r", encoding="utf-8") as mf:
-                manifest = json.load(mf)
-            if "filename" not in manifest or "parts" not in manifest:
-                return None, "manifest.json inválido: falta 'filename' o 'parts'"
-            if not isinstance(manifest["parts"], list) or not manifest["parts"]:
-                return None, "manifest.json inválido: 'parts' vacío"
-            return manifest, None
-        except Exception as e:
-            return None, f"Error leyendo manifest.json: {e}"
-
-    def _iter_parts(self, manifest):
+            st = os.stat(MANIFEST_PATH)
+        except OSError:
+            return None, None, f"manifest.json no encontrado en {PARTS_DIR}"
+        key = (st.st_mtime_ns, st.st_size)
+        cached = _manifest_cache
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2], None
+        with _manifest_lock:
+            cached = _manifest_cache
+            if cached is not None and cached[0] == key:
+                return cached[1], cached[2], None
+            try:
+                with open(MANIFEST_PATH, "r", encoding="utf-8") as mf:
+                    manifest = json.load(mf)
+                if "filename" not in manifest or "parts" not in manifest:
+                    return None, None, "manifest.json inválido: falta 'filename' o 'parts'"
+                if not isinstance(manifest["parts"], list) or not manifest["parts"]:
+                    return None, None, "manifest.json inválido: 'parts' vacío"
+                resolved = self._resolve_parts(manifest)
+            except Exception as e:
+                return None, None, f"Error leyendo manifest.json: {e}"
+            _manifest_cache = (key, manifest, resolved)
+            return manifest, resolved, None
+
+    def _resolve_parts(self, manifest):
         """
-        Itera (ruta_absoluta, size_declarado) en el orden declarado por manifest["parts"].
-        Cada item de 'parts' debe tener al menos 'path'; 'size' es opcional.
+        Devuelve [(ruta_absoluta, path)] en el orden declarado por
+        manifest["parts"]. ruta_absoluta es None si la entrada no es un objeto
+        con un 'path' de texto no vacío (el error se da al descargar, así /diag
+        sigue mostrando el manifest).
         """
+        resolved = []
         for entry in manifest["parts"]:
-            rel = entry.get("path")
-            if not rel:
-                raise FileNotFoundError("Entrada de parte sin 'path' en manifest")
-            abs_path = os.path.join(PARTS_DIR, rel)
-            if not os.path.exists(abs_path):
-                raise FileNotFoundError(f"Parte no encontrada: {rel}")
-            declared_size = entry.get("size")
-            yield abs_path, declared_size
-
-    def _total_length_from_manifest(self, manifest):
-        total = 0
-        complete = True
-        for entry in manifest.get("parts", []):
-            s = entry.get("size")
-            if isinstance(s, int):
-                total += s
+            rel = entry.get("path") if isinstance(entry, dict) else None
+            if not isinstance(rel, str) or not rel:
+                rel = None
+            abs_path = os.path.join(PARTS_DIR, rel) if rel else None
+            resolved.append((abs_path, rel))
+        return resolved
+
+    def _stat_parts(self, resolved):
+        """
+        Devuelve [(ruta_absoluta, size, os.stat_result)] para las partes de
+        _resolve_parts, con un único os.stat por parte. 'size' es el tamaño
+        real en disco (el 'size' del manifest es solo informativo).
+        """
+        parts = []
+        for abs_path, rel in resolved:
+            if abs_path is None:
+                raise FileNotFoundError("Entrada de parte sin 'path' válido en manifest")
+            try:
+                st = os.stat(abs_path)
+            except FileNotFoundError:
+                raise FileNotFoundError(f"Parte no encontrada: {rel}") from None
+            parts.append((abs_path, st.st_size, st))
+        return parts
+
+    def _not_modified(self, etag, mtime):
+        """True si If-None-Match / If-Modified-Since indican que el cliente ya lo tiene."""
+        inm = self.headers.get("If-None-Match")
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(",")]
+            return "*" in tags or etag in tags or f"W/{etag}" in tags
+        ims = self.headers.get("If-Modified-Since")
+        if ims:
+            try:
+                since = parsedate_to_datetime(ims)
+            except (TypeError, IndexError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def _send_cache_headers(self, etag, last_modified):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", DOWNLOAD_CACHE_CONTROL)
+
+    def _parse_range(self, header, length):
+        """
+        Interpreta un único rango 'bytes=a-b', 'bytes=a-' o 'bytes=-n'.
+        Devuelve (inicio, fin) inclusivos, o None si la cabecera no se entiende
+        (se ignora y se envía el archivo completo). Si inicio >= length el
+        rango no es satisfacible.
+        """
+        unit, _, spec = header.partition("=")
+        if unit.strip().lower() != "bytes" or "," in spec:
+            return None
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else length - 1
+                if start < 0 or (last and end < start):
+                    return None
             else:
-                complete = False
+                suffix = int(last)  # últimos 'suffix' bytes
+                if suffix <= 0:
+                    return (length, length) if suffix == 0 else None
+                start, end = max(length - suffix, 0), length - 1
+        except ValueError:
+            return None
+        return start, min(end, length - 1)
+
+    def _send_file(self, f, offset, count):
+        """
+        Envía como máximo 'count' bytes de 'f' (abierto en binario) desde
+        'offset' al socket del cliente y devuelve cuántos envió (menos si el
+        archivo se acortó). Con os.sendfile los bytes van del page cache al
+        socket sin pasar por Python; si no existe (Windows), se copia en bloques.
+        """
+        if hasattr(os, "sendfile"):
+            self.wfile.flush()
+            return self.connection.sendfile(f, offset, count)
+        if self._copy_buf is None:
+            self._copy_buf = memoryview(bytearray(CHUNK_SIZE))
+        buf = self._copy_buf
+        f.seek(offset)
+        sent = 0
+        while sent < count:
+            n = f.readinto(buf if count - sent >= CHUNK_SIZE else buf[:count - sent])
+            if not n:
+                break
+            self.wfile.write(buf[:n])
+            sent += n
+        return sent
+
+    def _advise_sequential(self, f, offset, count):
+        """
+        Avisa al kernel de que [offset, offset+count) se leerá de corrido, para
+        que use un readahead mayor y empiece a cargarlo ya. No se usa DONTNEED
+        al terminar: las partes las comparten todas las descargas en curso.
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        fd = f.fileno()
+        try:
+            os.posix_fadvise(fd, offset, count, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, offset, count, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass  # solo es una pista (p. ej. EINVAL en FUSE/overlay)
+
+    def _send_parts(self, parts, start, count):
+        """
+        Envía 'count' bytes de la concatenación de partes a partir del byte
+        'start' del archivo combinado. 'parts' viene de _stat_parts; nunca se
+        envía más de lo anunciado en Content-Length, y si una parte se acortó
+        desde que se midió se lanza OSError.
+        """
+        pos = 0
+        for abs_path, size, _st in parts:
+            if count <= 0:
                 break
-        return total if complete else None
+            part_start = pos
+            pos += size
+            if pos <= start:
+                continue
+            offset = max(start - part_start, 0)
+            n = min(size - offset, count)
+            with open(abs_path, "rb") as f:
+                self._advise_sequential(f, offset, n)
+                if self._send_file(f, offset, n) < n:
+                    raise OSError(f"Parte truncada: {os.path.basename(abs_path)}")
+            count -= n
 
     # -------- endpoints --------
     def _send_download_streaming(self):
         # 1) Cargar manifest
-        manifest, err = self._load_manifest()
+        manifest, resolved, err = self._load_manifest()
         if err:
             self.send_error(404, err)
             return
@@ -86,49 +279,100 @@ class Handler(SimpleHTTPRequestHandler):
         filename = DOWNLOAD_NAME_OVERRIDE or manifest.get("filename", "download.bin")
         mime = manifest.get("mime", "application/octet-stream")
 
-        # 2) Calcular Content-Length si posible (suma sizes del manifest)
-        content_length = self._total_length_from_manifest(manifest)
+        # 2) Validar partes antes de los headers, con un os.stat cada una
+        #    (existencia + tamaño + mtime)
+        try:
+            parts = self._stat_parts(resolved)
+        except FileNotFoundError as e:
+            self.send_error(404, str(e))
+            return
 
-        # 3) Responder headers
-        self.send_response(200)
-        self.send_header("Content-Type", mime)
-        if content_length is not None:
+        # Content-Length: suma de los tamaños reales en disco
+        content_length = sum(size for _path, size, _st in parts)
+
+        # 3) ETag/Last-Modified; 304 si el cliente ya tiene esta versión
+        parts_mtime = max(st.st_mtime for _path, _size, st in parts)
+        etag = f'"{int(parts_mtime)}-{content_length}"'
+        last_modified = formatdate(parts_mtime, usegmt=True)
+        if self._not_modified(etag, parts_mtime):
+            self.send_response(304)
+            self._send_cache_headers(etag, last_modified)
+            self.end_headers()
+            return
+
+        # 4) Range (permite reanudar). Con If-Range, solo si sigue siendo la
+        #    misma versión.
+        byte_range = None
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range not in (etag, last_modified):
+            range_header = None
+        if range_header:
+            byte_range = self._parse_range(range_header, content_length)
+            if byte_range and byte_range[0] >= content_length:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{content_length}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        # 5) Responder headers
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{content_length}")
+            self.send_header("Content-Length", str(end - start + 1))
+        else:
+            self.send_response(200)
             self.send_header("Content-Length", str(content_length))
+        self.send_header("Content-Type", mime)
+        self.send_header("Accept-Ranges", "bytes")
+        self._send_cache_headers(etag, last_modified)
         self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
         self.end_headers()
 
-        # 4) Enviar concatenación de partes en bloques
+        # 6) Enviar concatenación de partes (sendfile: copia dentro del kernel).
+        #    Un cliente lento o en pausa no debe cortar por el timeout de keep-alive
+        self.connection.settimeout(TRANSFER_TIMEOUT)
         try:
-            for abs_path, _declared in self._iter_parts(manifest):
-                with open(abs_path, "rb") as f:
-                    while True:
-                        chunk = f.read(64 * 1024)
-                        if not chunk:
-                            break
-                        self.wfile.write(chunk)
-        except FileNotFoundError as e:
-            # Si alguna parte falta, devolvemos 500 después de headers
-            # (el cliente verá descarga interrumpida)
-            # Para depurar fácil:
-            try:
-                self.wfile.write(f"\nERROR: {e}".encode("utf-8"))
-            except Exception:
-                pass
+            if byte_range:
+                self._send_parts(parts, start, end - start + 1)
+            else:
+                self._send_parts(parts, 0, content_length)
+        except OSError as e:
+            # Con los headers ya enviados no se puede responder un error: nada
+            # más al cuerpo (rompería Content-Length), se registra y se cierra
+            # la conexión; el cliente verá la descarga interrumpida
+            self.close_connection = True
+            self.log_error("Descarga interrumpida: %s", e)
+        finally:
+            self.connection.settimeout(self.timeout)
 
     def _diag(self):
         def tree(root):
+            # Recorrido en profundidad con os.scandir, limitado en niveles y
+            # líneas para que /diag no recorra árboles enormes (p. ej. .git)
             lines = []
-            for dirpath, dirnames, filenames in os.walk(root):
-                rel = os.path.relpath(dirpath, root)
-                rel = "." if rel == "." else rel
-                lines.append(f"[{rel}]")
-                for d in sorted(dirnames):
-                    lines.append(f"  <DIR> {d}")
-                for f in sorted(filenames):
-                    lines.append(f"       {f}")
+            pending = [(root, 0)]
+            while pending and len(lines) < DIAG_MAX_LINES:
+                dirpath, depth = pending.pop()
+                try:
+                    with os.scandir(dirpath) as it:
+                        entries = sorted(it, key=lambda e: e.name)
+                except OSError:
+                    continue
+                dirs = [e for e in entries if e.is_dir()]
+                lines.append(f"[{os.path.relpath(dirpath, root)}]")
+                lines.extend(f"  <DIR> {e.name}" for e in dirs)
+                lines.extend(f"       {e.name}" for e in entries if not e.is_dir())
+                if depth < DIAG_MAX_DEPTH:
+                    pending.extend((e.path, depth + 1) for e in reversed(dirs)
+                                   if not e.is_symlink())
+            if pending or len(lines) > DIAG_MAX_LINES:
+                lines = lines[:DIAG_MAX_LINES] + ["  ... (recortado)"]
             return "\n".join(lines)
 
-        manifest, err = self._load_manifest()
+        manifest, _resolved, err = self._load_manifest()
         man_info = "NO MANIFEST" if err else json.dumps(
             {"filename": manifest.get("filename"),
              "mime": manifest.get("mime"),
@@ -150,8 +394,7 @@ class Handler(SimpleHTTPRequestHandler):
         self.wfile.write(msg)
 
     def _where(self):
-        man_path = os.path.join(PARTS_DIR, "manifest.json")
-        info = f"BASE_DIR={BASE_DIR}\nPARTS_DIR={PARTS_DIR}\nMANIFEST={man_path}\n"
+        info = f"BASE_DIR={BASE_DIR}\nPARTS_DIR={PARTS_DIR}\nMANIFEST={MANIFEST_PATH}\n"
         data = info.encode("utf-8")
         self.send_response(200)
         self.send_header("Content-Type", "text/plain; charset=utf-8")
@@ -159,15 +402,61 @@ class Handler(SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(data)
 
+class PooledHTTPServer(ThreadingHTTPServer):
+    """
+    ThreadingHTTPServer que atiende cada conexión en un pool fijo de hilos
+    daemon (como daemon_threads) en vez de crear un hilo nuevo por conexión,
+    así una descarga en curso no retrasa la salida. Con todos los hilos ocupados,
+    hasta max_workers conexiones más esperan ya aceptadas y las keep-alive se
+    cierran tras su respuesta para dejarles sitio; pasado ese límite deja de
+    aceptar y las nuevas esperan en la cola de listen().
+    """
+    request_queue_size = 128
+
+    def __init__(self, *args, max_workers=MAX_WORKERS, **kwargs):
+        # Antes de super().__init__: si falla el bind, este llama a server_close()
+        self._pending = queue.Queue(maxsize=max_workers)
+        super().__init__(*args, **kwargs)
+        for i in range(max_workers):
+            threading.Thread(target=self._worker, name=f"http-worker-{i}",
+                             daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self._pending.put((request, client_address))
+
+    def saturated(self):
+        """True si hay conexiones aceptadas esperando un hilo libre."""
+        return not self._pending.empty()
+
+    def _worker(self):
+        while True:
+            request, client_address = self._pending.get()
+            self.process_request_thread(request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        # Cierra las conexiones aceptadas que ningún hilo llegó a atender
+        while True:
+            try:
+                request, _client_address = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            self.shutdown_request(request)
+
 def main():
     os.chdir(BASE_DIR)
-    httpd = ThreadingHTTPServer(("0.0.0.0", PORT), Handler)
+    httpd = PooledHTTPServer(("0.0.0.0", PORT), Handler)
     print(f"[OK] Server en http://localhost:{PORT}/")
     print("  /          -> index.html")
     print("  /download  -> reconstruye y descarga desde manifest+partes")
     print("  /diag      -> diagnóstico (árbol de archivos y manifest)")
     print("  /where     -> rutas internas (BASE_DIR, PARTS_DIR, manifest)")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
 
 if __name__ == "__main__":
     main()